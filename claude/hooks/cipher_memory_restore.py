@@ -9,13 +9,17 @@ import sys
 import os
 import logging
 import re
-import subprocess
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Optional
 
+# プロファイリング有効時はここから計測（以降のimportのコストも含める）
+from profiling import start_profiling, profile_run, run_measured
+start_profiling()
+
 # 共通設定とユーティリティをインポート
 from config import CIPHER_CONFIG, MESSAGE_CONFIG
-from utils import setup_logging, extract_project_context, truncate_for_log
+from utils import setup_logging, extract_project_context, truncate_for_log, build_search_queries, hook_child_env
+from incremental_state import is_incremental_enabled
 
 # ログ設定
 logger = setup_logging('RESTORE')
@@ -44,20 +48,7 @@ def search_cipher_memory(session_id: str, project_context: Dict[str, Any]) -> Di
         project_name = project_context.get('name', 'unknown')
 
         # 検索クエリを優先度順に構築
-        search_queries = []
-
-        # 1. 直前のセッションのauto-compactメモリ
-        if session_id and session_id != 'unknown':
-            search_queries.append(f"session-id:{session_id[:8]} auto-compact")
-
-        # 2. 同一プロジェクトの進行中タスク
-        if project_name != 'unknown':
-            search_queries.append(f"project:{project_name} status:in-progress")
-            search_queries.append(f"project:{project_name} priority:high")
-
-        # 3. 最近の高優先度タスク
-        search_queries.append("auto-compact priority:high")
-        search_queries.append("status:in-progress recent")
+        search_queries = build_search_queries(session_id, project_name, is_incremental_enabled())
 
         logger.info(f"Searching Cipher with queries: {search_queries}")
 
@@ -90,12 +81,11 @@ def search_cipher_memory(session_id: str, project_context: Dict[str, Any]) -> Di
 見つからない場合は「関連記憶なし」と返してください。"""
 
                 # Claude CLI実行
-                result = subprocess.run(
+                result = run_measured(
                     CIPHER_CONFIG['claude_cli_command'],
-                    input=search_prompt,
-                    capture_output=True,
-                    text=True,
-                    timeout=CIPHER_CONFIG['timeout_seconds']
+                    search_prompt,
+                    CIPHER_CONFIG['timeout_seconds'],
+                    env=hook_child_env()
                 )
 
                 if result.returncode == 0 and result.stdout.strip():
@@ -268,4 +258,6 @@ def main():
     sys.exit(0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # CIPHER_HOOK_PROFILE=1 で実行全体をプロファイル
+    with profile_run('restore'):
+        main()
\ No newline at end of file
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+プロジェクト単位のメモリロールアップ
+同じプロジェクト・セッション種別のメモリを最新状態の1件にまとめ、古いメモリを引退させる
+会話の断片（インクリメンタル保存の差分やcompact時の残り）は置き換えずにセッションごとに順番に連結する
+cronなどから定期実行し、前回のウォーターマーク以降に増えたグループだけを処理する
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+import statistics
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional, Tuple, Iterator
+
+from config import ROLLUP_CONFIG
+from utils import setup_logging, build_search_queries, get_current_timestamp
+from memory_store import LocalMemoryStore, tag_value
+
+# ログ設定
+logger = setup_logging('ROLLUP')
+
+STATE_FILE = 'rollup_state.json'
+LOCK_FILE = 'rollup.lock'
+ROLLUP_TAG = 'rollup'
+SESSION_GROUP_PREFIX = 'session:'
+
+def load_rollup_state(store: LocalMemoryStore) -> Dict[str, Any]:
+    """前回処理済みの最大メモリIDと、前回作成したロールアップのID"""
+    try:
+        with open(os.path.join(store.store_dir, STATE_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+@contextmanager
+def rollup_lock(store: LocalMemoryStore) -> Iterator[bool]:
+    """ロールアップ全体の排他ロック（重なった実行で同じグループを二重にまとめない）。取得できたかどうかをyieldする"""
+    with open(os.path.join(store.store_dir, LOCK_FILE), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def save_rollup_state(store: LocalMemoryStore, watermark: int, rollup_ids: List[int]) -> None:
+    """ウォーターマークと今回作成したロールアップのIDを記録"""
+    path = os.path.join(store.store_dir, STATE_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"watermark": watermark, "rollup_ids": rollup_ids, "updated_at": get_current_timestamp()}, f)
+    os.replace(tmp_path, path)
+
+def is_slice(memory: Dict[str, Any]) -> bool:
+    """会話の一部分だけを持つメモリか（新しいメモリが古いメモリを置き換えない）"""
+    metadata = memory.get('metadata', {})
+    return (tag_value(memory['tags'], 'session-type') == 'incremental'
+            or metadata.get('context', {}).get('partial', False)
+            or metadata.get('slices', False))
+
+def group_key(memory: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """グループキー。プロジェクトかセッション種別のタグがなければまとめない
+
+    通常のメモリは (プロジェクト, セッション種別) で最新が古いものを置き換え、
+    断片は (プロジェクト, session:ID) でセッションごとに連結する
+    """
+    project = tag_value(memory['tags'], 'project')
+    session_type = tag_value(memory['tags'], 'session-type')
+    if not project or not session_type:
+        return None
+    if is_slice(memory):
+        return project, f"{SESSION_GROUP_PREFIX}{memory.get('metadata', {}).get('sessionId', 'unknown')}"
+    return project, session_type
+
+def history_entry(memory: Dict[str, Any]) -> Dict[str, Any]:
+    """ロールアップに残す過去メモリの要約"""
+    metadata = memory.get('metadata', {})
+    return {
+        "id": memory['id'],
+        "sessionId": metadata.get('sessionId', 'unknown'),
+        "timestamp": metadata.get('timestamp', memory['created_at']),
+        "status": tag_value(memory['tags'], 'status') or 'unknown'
+    }
+
+def merged_history(members: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """以前のロールアップの履歴を引き継ぎ、今回まとめたメモリを追加"""
+    history: List[Dict[str, Any]] = []
+    for memory in members:
+        if ROLLUP_TAG in memory['tags']:
+            history.extend(memory['metadata'].get('history', []))
+        else:
+            history.append(history_entry(memory))
+    return history[-ROLLUP_CONFIG['max_history']:]
+
+def merged_tags(members: List[Dict[str, Any]]) -> List[str]:
+    """最新メモリのタグを基本に、言語タグは全体の和集合"""
+    tags = [tag for tag in members[-1]['tags'] if tag != ROLLUP_TAG and not tag.startswith('lang:')]
+    for memory in members:
+        tags.extend(tag for tag in memory['tags'] if tag.startswith('lang:') and tag not in tags)
+    tags.append(ROLLUP_TAG)
+    return tags
+
+def merge_group(key: Tuple[str, str], members: List[Dict[str, Any]]) -> Tuple[str, List[str], Dict[str, Any]]:
+    """グループのメモリを1件にまとめる（members は古い順）"""
+    if key[1].startswith(SESSION_GROUP_PREFIX):
+        return merge_slices(key, members)
+    return merge_superseded(key, members)
+
+def merge_slices(key: Tuple[str, str], members: List[Dict[str, Any]]) -> Tuple[str, List[str], Dict[str, Any]]:
+    """1セッションの断片を古い順に連結する（どの断片も検索できるよう内容は全て残す）"""
+    project = key[0]
+    session_id = key[1][len(SESSION_GROUP_PREFIX):]
+
+    parts = [memory['metadata'].get('currentContent', memory['content']) if ROLLUP_TAG in memory['tags']
+             else memory['content'] for memory in members]
+    body = "\n\n---\n\n".join(parts)
+    content = "\n".join([
+        "Claude Code Memory Rollup",
+        "",
+        f"# Session Slices ({len(members)} memories concatenated)",
+        f"- Project: {project}",
+        f"- Session: {session_id}",
+        "",
+        body
+    ])
+
+    metadata = {
+        "source": ROLLUP_TAG,
+        "projectId": project,
+        "sessionType": tag_value(members[-1]['tags'], 'session-type'),
+        "sessionId": session_id,
+        "slices": True,
+        "timestamp": get_current_timestamp(),
+        "mergedIds": [memory['id'] for memory in members],
+        "history": merged_history(members),
+        "currentContent": body
+    }
+    return content, merged_tags(members), metadata
+
+def merge_superseded(key: Tuple[str, str], members: List[Dict[str, Any]]) -> Tuple[str, List[str], Dict[str, Any]]:
+    """最新のメモリを現在の状態とし、古いメモリは履歴として残す"""
+    project, session_type = key
+    latest = members[-1]
+    history = merged_history(members)
+    tags = merged_tags(members)
+
+    latest_content = latest['content']
+    if ROLLUP_TAG in latest['tags']:
+        latest_content = latest['metadata'].get('currentContent', latest_content)
+
+    history_lines = [f"- {entry['timestamp']} session {entry['sessionId'][:8]} status:{entry['status']}"
+                     for entry in history]
+    content = "\n".join([
+        "Claude Code Memory Rollup",
+        "",
+        f"# Current State ({len(members)} memories merged)",
+        f"- Project: {project}",
+        f"- Session Type: {session_type}",
+        f"- Latest Session: {latest['metadata'].get('sessionId', 'unknown')}",
+        "",
+        latest_content,
+        "",
+        "# History",
+        *history_lines
+    ])
+
+    metadata = {
+        "source": ROLLUP_TAG,
+        "projectId": project,
+        "sessionType": session_type,
+        "sessionId": latest['metadata'].get('sessionId', 'unknown'),
+        "timestamp": get_current_timestamp(),
+        "mergedIds": [memory['id'] for memory in members],
+        "history": history,
+        "currentContent": latest_content
+    }
+    return content, tags, metadata
+
+def measure_search_latency(store: LocalMemoryStore, queries: List[str]) -> Optional[float]:
+    """クエリ一式の検索にかかる時間の中央値（ms）"""
+    if not queries:
+        return None
+    samples = []
+    for _ in range(ROLLUP_CONFIG['latency_runs']):
+        start = time.perf_counter()
+        for query in queries:
+            store.search(query)
+        samples.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(samples), 2)
+
+def run_rollup(store: LocalMemoryStore, full: bool = False, dry_run: bool = False) -> Dict[str, Any]:
+    """ウォーターマーク以降に更新されたグループをまとめ、結果を返す"""
+    state = {} if full else load_rollup_state(store)
+    watermark = state.get('watermark', 0)
+    previous_rollups = set(state.get('rollup_ids', []))
+
+    # 以降はこの時点のスナップショットだけを処理する（実行中に追加されたメモリは次回に回す）
+    active = store.list()
+    new_memories = [memory for memory in active
+                    if memory['id'] > watermark and memory['id'] not in previous_rollups]
+    affected = {key for key in map(group_key, new_memories) if key}
+    logger.info(f"{len(new_memories)} memories since watermark {watermark}, {len(affected)} groups affected")
+
+    # 検索レイテンシは復元フックと同じクエリで測定
+    queries = list(dict.fromkeys(
+        query for project, _ in sorted(affected) for query in build_search_queries('unknown', project)))
+    latency_before = measure_search_latency(store, queries)
+
+    groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = defaultdict(list)
+    for memory in active:
+        key = group_key(memory)
+        if key in affected:
+            groups[key].append(memory)
+
+    rollup_ids: List[int] = []
+    compacted = 0
+    for key, members in sorted(groups.items()):
+        if len(members) < ROLLUP_CONFIG['min_group_size']:
+            continue
+        content, tags, metadata = merge_group(key, members)
+        if dry_run:
+            compacted += len(members)
+            continue
+        # 追加と引退を1つのトランザクションで行い、途中で落ちても両方がアクティブにならないようにする
+        replaced = store.replace([memory['id'] for memory in members], content, tags, metadata)
+        if replaced is None:
+            logger.warning(f"Skipped project:{key[0]} group {key[1]}: members were retired by another process")
+            continue
+        rollup_id, retired = replaced
+        compacted += retired
+        rollup_ids.append(rollup_id)
+        logger.info(f"Rolled up {len(members)} memories for project:{key[0]} group {key[1]} into #{rollup_id}")
+
+    latency_after = measure_search_latency(store, queries)
+
+    # ウォーターマークはスナップショット内の最大IDまで。今回作ったロールアップは次回の新規扱いから除く
+    new_watermark = max([watermark] + [memory['id'] for memory in active])
+    if not dry_run:
+        save_rollup_state(store, new_watermark, rollup_ids)
+
+    return {
+        "dry_run": dry_run,
+        "watermark": {"from": watermark, "to": new_watermark},
+        "groups_affected": len(affected),
+        "rollups_created": len(rollup_ids),
+        "memories_compacted": compacted,
+        "active_before": len(active),
+        "active_after": len(store.list()),
+        "search_latency_ms_before": latency_before,
+        "search_latency_ms_after": latency_after
+    }
+
+def main():
+    """メイン処理"""
+    parser = argparse.ArgumentParser(description="Roll up per-project memories into current-state memories")
+    parser.add_argument('--store', default=None, help="local memory store directory")
+    parser.add_argument('--full', action='store_true', help="ignore the watermark and process every group")
+    parser.add_argument('--dry-run', action='store_true', help="report what would be compacted without changing the store")
+    args = parser.parse_args()
+
+    logger.info("Memory rollup started")
+    store = LocalMemoryStore(args.store)
+    try:
+        with rollup_lock(store) as acquired:
+            if not acquired:
+                logger.info("Another memory rollup is running, skipping")
+                return
+            report = run_rollup(store, full=args.full, dry_run=args.dry_run)
+    except Exception as e:
+        logger.error(f"Memory rollup failed: {e}")
+        sys.exit(1)
+
+    logger.info(f"Memory rollup finished: compacted {report['memories_compacted']} memories, "
+                f"search latency {report['search_latency_ms_before']}ms -> {report['search_latency_ms_after']}ms")
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -10,16 +10,44 @@ import os
 import logging
 import re
 import subprocess
+import time
 from datetime import datetime
 from typing import Dict, List, Any, Optional
 
+# プロファイリング有効時はここから計測（以降のimportのコストも含める）
+from profiling import start_profiling, profile_run, set_run_name, discard_profile, paused, run_measured
+start_profiling()
+
 # 共通設定とユーティリティをインポート
-from config import CIPHER_CONFIG, MESSAGE_CONFIG, PROJECT_CONFIG, LANGUAGE_PATTERNS, TASK_PATTERNS, PRIORITY_PATTERNS, STATUS_PATTERNS
-from utils import setup_logging, extract_project_context, truncate_for_log, get_current_timestamp
+from config import CIPHER_CONFIG, MESSAGE_CONFIG, PROJECT_CONFIG, INCREMENTAL_CONFIG, LANGUAGE_PATTERNS, TASK_PATTERNS, PRIORITY_PATTERNS, STATUS_PATTERNS
+from utils import setup_logging, extract_project_context, truncate_for_log, get_current_timestamp, is_hook_child, hook_child_env
+from incremental_state import (
+    is_incremental_enabled, load_state, save_state, record_event,
+    last_event_ns, seconds_since_event, seconds_pending, mark_flushed, prune_stale_state,
+    session_lock, worker_lock
+)
+from transcript import read_transcript, read_transcript_tail, extract_conversation_content
+from conversation_archive import archive_snapshot
+from memory_store import mirror_memory
 
 # ログ設定
 logger = setup_logging('SAVE')
 
+# インクリメンタル保存を起動するフックイベント
+INCREMENTAL_EVENTS = ('Stop', 'PostToolUse')
+
+# 保存イベントごとの説明文
+EVENT_DESCRIPTIONS = {
+    'auto-compact': {
+        'event': 'auto-compact triggered',
+        'scope': 'auto-compact直前の会話内容'
+    },
+    'incremental': {
+        'event': 'incremental save during session',
+        'scope': 'セッション途中の会話差分'
+    }
+}
+
 def read_stdin_json() -> Optional[Dict[str, Any]]:
     """標準入力からJSONを読み取る"""
     try:
@@ -36,73 +64,6 @@ def read_stdin_json() -> Optional[Dict[str, Any]]:
         logger.error(f"Error reading stdin: {e}")
         return None
 
-def read_transcript(transcript_path: str) -> Optional[List[Dict[str, Any]]]:
-    """トランスクリプトファイルを読み取る"""
-    try:
-        if not os.path.exists(transcript_path):
-            logger.error(f"Transcript file not found: {transcript_path}")
-            return None
-
-        messages = []
-        with open(transcript_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    try:
-                        messages.append(json.loads(line))
-                    except json.JSONDecodeError:
-                        continue
-
-        logger.info(f"Read {len(messages)} messages from transcript")
-        return messages
-    except Exception as e:
-        logger.error(f"Error reading transcript: {e}")
-        return None
-
-def extract_conversation_content(messages: List[Dict[str, Any]], limit: int = MESSAGE_CONFIG['default_limit']) -> str:
-    """会話内容から重要な部分を抽出"""
-    try:
-        # 最新のメッセージから指定数を取得
-        recent_messages = messages[-limit:] if len(messages) > limit else messages
-
-        conversation_parts = []
-        for msg in recent_messages:
-            msg_type = msg.get('type', '')
-            message_data = msg.get('message', {})
-
-            # userまたはassistantメッセージの処理
-            if msg_type in ['user', 'assistant'] and message_data:
-                role = message_data.get('role', msg_type)
-                content = message_data.get('content', '')
-
-                # contentが文字列の場合
-                if isinstance(content, str) and content.strip():
-                    conversation_parts.append(f"[{role}]: {content}")
-                # contentが配列の場合（tool_useなど）
-                elif isinstance(content, list):
-                    for item in content:
-                        if isinstance(item, dict):
-                            if item.get('type') == 'text':
-                                text = item.get('text', '')
-                                if text.strip():
-                                    conversation_parts.append(f"[{role}]: {text}")
-                            elif item.get('type') == 'tool_use':
-                                tool_name = item.get('name', 'unknown_tool')
-                                conversation_parts.append(f"[{role}-tool]: {tool_name}")
-
-        logger.info(f"Extracted {len(conversation_parts)} conversation parts from {len(recent_messages)} messages")
-
-        # デバッグ：コンテンツが抽出されなかった場合
-        if not conversation_parts and recent_messages:
-            logger.warning(f"No conversation parts extracted from {len(recent_messages)} messages")
-            sample_msg = recent_messages[0]
-            logger.debug(f"Sample message structure: {list(sample_msg.keys())}")
-
-        return "\n".join(conversation_parts)
-    except Exception as e:
-        logger.error(f"Error extracting conversation content: {e}")
-        return ""
-
 # extract_project_context は shared_utils から使用
 
 def detect_languages(content: str) -> List[str]:
@@ -127,9 +88,9 @@ def detect_project_status(content: str) -> str:
             return status
     return 'active'
 
-def generate_smart_tags(conversation_content: str, project_context: Dict[str, Any]) -> List[str]:
+def generate_smart_tags(conversation_content: str, project_context: Dict[str, Any], event: str = 'auto-compact') -> List[str]:
     """会話内容から智能的にタグを生成"""
-    tags = ["auto-compact"]
+    tags = [event]
 
     # プロジェクト関連タグ
     if project_name := project_context.get('name'):
@@ -167,11 +128,15 @@ def count_messages(conversation_content: str) -> int:
     """会話メッセージ数をカウント"""
     return len([line for line in conversation_content.split('\n') if line.strip().startswith('[')])
 
-def save_to_cipher(conversation_content: str, session_id: str, transcript_path: str) -> bool:
-    """Cipherに会話内容を構造化して保存（MCP経由）"""
+def save_to_cipher(conversation_content: str, session_id: str, transcript_path: str, event: str = 'auto-compact', partial: bool = False) -> bool:
+    """Cipherに会話内容を構造化して保存（MCP経由）
+
+    partialは会話の一部分（インクリメンタル保存の差分やcompact時の残り）であることを示す
+    """
     try:
         timestamp = get_current_timestamp()
         project_context = extract_project_context(transcript_path)
+        description = EVENT_DESCRIPTIONS[event]
 
         # 構造化されたメモリ内容
         memory_content = f"""
@@ -180,12 +145,12 @@ Claude Code Auto-Compact Memory Archive
 # Session Context
 - Session ID: {session_id}
 - Timestamp: {timestamp}
-- Event: auto-compact triggered
+- Event: {description['event']}
 - Project: {project_context.get('name', 'unknown')}
 - Working Directory: {project_context.get('path', 'unknown')}
 
 # Summary Request
-以下のauto-compact直前の会話内容から、次のセッションで継続作業するために必要な情報を抽出・要約して `ask_cipher` を使って記憶してください。
+以下の{description['scope']}から、次のセッションで継続作業するために必要な情報を抽出・要約して `ask_cipher` を使って記憶してください。
 
 {conversation_content}
 
@@ -207,25 +172,26 @@ Claude Code Auto-Compact Memory Archive
 ## 🏷️ Classification Tags
 以下の形式でタグ付けしてください：
 - project:{project_context.get('name', 'unknown')}
-- session-type:auto-compact
+- session-type:{event}
 - language:{','.join(detect_languages(conversation_content))}
 - status:{detect_project_status(conversation_content)}
         """.strip()
 
         # 強化されたメタデータ
-        smart_tags = generate_smart_tags(conversation_content, project_context)
+        smart_tags = generate_smart_tags(conversation_content, project_context, event)
         metadata = {
             "sessionId": session_id,
-            "source": "auto-compact",
+            "source": event,
             "projectId": project_context.get('name'),
             "timestamp": timestamp,
             "tags": smart_tags,
             "context": {
-                "triggerEvent": "auto-compact",
+                "triggerEvent": event,
                 "messageCount": count_messages(conversation_content),
                 "workingDirectory": project_context.get('path'),
                 "detectedLanguages": detect_languages(conversation_content),
-                "projectStatus": detect_project_status(conversation_content)
+                "projectStatus": detect_project_status(conversation_content),
+                "partial": partial
             }
         }
 
@@ -239,12 +205,11 @@ Claude Code Auto-Compact Memory Archive
 
         try:
             # Claude CLI実行
-            result = subprocess.run(
+            result = run_measured(
                 CIPHER_CONFIG['claude_cli_command'],
-                input=memory_content,
-                capture_output=True,
-                text=True,
-                timeout=CIPHER_CONFIG['timeout_seconds']
+                memory_content,
+                CIPHER_CONFIG['timeout_seconds'],
+                env=hook_child_env()
             )
 
             if result.returncode == 0:
@@ -256,6 +221,9 @@ Claude Code Auto-Compact Memory Archive
                 response_preview = truncate_for_log(result.stdout, MESSAGE_CONFIG['max_response_length'])
                 logger.info(f"🔍 Cipher response: {response_preview}")
 
+                # ローカルストアにも同じタグで記録（有効時のみ）
+                mirror_memory(memory_content, smart_tags + [f"session-type:{event}"], metadata)
+
                 return True
             else:
                 logger.error(f"Claude CLI failed with return code {result.returncode}")
@@ -276,16 +244,178 @@ Claude Code Auto-Compact Memory Archive
         logger.error(f"Error saving enhanced memory to Cipher: {e}")
         return False
 
+def save_in_batches(session_id: str, transcript_path: str, state: Dict[str, Any],
+                    messages: List[Dict[str, Any]], message_ends: List[int], end_offset: int,
+                    event: str, persist: bool = True) -> bool:
+    """未保存のメッセージをmax_batch_messagesずつ古い順に保存する
+
+    保存できたバッチの終端までだけオフセットを進めるため、失敗しても未送信のメッセージは次回に残る
+    persistがFalseの場合は状態を更新しない（セッションロックを取れなかった場合）
+    """
+    max_batch = INCREMENTAL_CONFIG['max_batch_messages']
+    offset = state.get('offset', 0)
+    # 既に一部が保存済み、または複数バッチに分かれる場合は会話の断片として保存
+    partial = event == 'incremental' or offset > 0 or len(messages) > max_batch
+    saved_messages = state.get('saved_messages', 0)
+
+    for start in range(0, len(messages), max_batch):
+        batch = messages[start:start + max_batch]
+        is_last = start + max_batch >= len(messages)
+        batch_end = end_offset if is_last else message_ends[start + len(batch) - 1]
+
+        conversation_content = extract_conversation_content(batch, len(batch))
+        if conversation_content:
+            if not save_to_cipher(conversation_content, session_id, transcript_path, event, partial):
+                return False
+            # 保存に成功したバッチだけをアーカイブ（再試行で同じ内容を重複させない）
+            archive_snapshot(conversation_content, session_id, transcript_path)
+
+        offset = batch_end
+        saved_messages += len(batch)
+        if persist:
+            save_state(session_id, {
+                "offset": offset,
+                "saved_messages": saved_messages,
+                "transcript_path": transcript_path
+            })
+
+    if persist:
+        mark_flushed(session_id)
+    return True
+
+def run_incremental_save(input_data: Dict[str, Any]) -> bool:
+    """Stop / PostToolUse イベントで新しい差分だけをデバウンスして保存"""
+    if not is_incremental_enabled():
+        discard_profile()
+        return True
+
+    # 保存用に起動したClaude CLIセッション自身のイベントは保存しない
+    if is_hook_child():
+        logger.debug("Skipping incremental save inside a hook-spawned Claude CLI session")
+        discard_profile()
+        return True
+
+    session_id = input_data.get('session_id', 'unknown')
+    transcript_path = input_data.get('transcript_path', '')
+    if not transcript_path:
+        logger.error("No transcript_path in hook input")
+        return False
+
+    # イベントを記録し、ワーカーがいなければ自分がワーカーになる
+    # ワーカーがいる場合は記録したイベントをそのワーカーが拾うので、すぐに終了する
+    record_event(session_id)
+    became_worker = False
+    while True:
+        with worker_lock(session_id) as acquired:
+            if not acquired:
+                logger.debug("Incremental worker already running for this session")
+                # 記録だけして終了するプロセスのプロファイルは残さない
+                if not became_worker:
+                    discard_profile()
+                return True
+            became_worker = True
+
+            while True:
+                handled_ns = wait_for_quiet(session_id)
+                if not flush_incremental(session_id, transcript_path):
+                    return False
+                # 保存中に届いたイベントがあれば続けて処理
+                if last_event_ns(session_id) <= handled_ns:
+                    break
+
+        # ロック解放の直前に届いたイベントを取りこぼさないよう再確認
+        if last_event_ns(session_id) <= handled_ns:
+            prune_session_state(session_id)
+            return True
+
+def prune_session_state(session_id: str) -> None:
+    """古いセッションの状態ファイルを削除（失敗しても保存結果には影響させない）"""
+    try:
+        prune_stale_state(session_id)
+    except Exception as e:
+        logger.error(f"Error pruning incremental state: {e}")
+
+def wait_for_quiet(session_id: str) -> int:
+    """最後のイベントからdebounce_seconds静かになるか、保存以降で最初のイベントからmax_wait_seconds経つまで待つ
+
+    待ち終えた時点で把握している最後のイベント時刻（ns）を返す
+    """
+    debounce = INCREMENTAL_CONFIG['debounce_seconds']
+    max_wait = INCREMENTAL_CONFIG['max_wait_seconds']
+    while True:
+        handled_ns = last_event_ns(session_id)
+        quiet_remaining = debounce - seconds_since_event(session_id)
+        flush_remaining = max_wait - seconds_pending(session_id)
+        if quiet_remaining <= 0 or flush_remaining <= 0:
+            return handled_ns
+        # 待ち時間はプロファイルから外す
+        with paused():
+            time.sleep(min(quiet_remaining, flush_remaining))
+
+def flush_incremental(session_id: str, transcript_path: str) -> bool:
+    """前回保存位置以降の差分を保存"""
+    with session_lock(session_id) as acquired:
+        if not acquired:
+            logger.info("Another incremental save is in progress, skipping")
+            return True
+
+        state = load_state(session_id)
+        messages, message_ends, end_offset = read_transcript_tail(transcript_path, state.get('offset', 0))
+        if messages is None:
+            return False
+
+        # 小さな差分は次回にまとめる
+        if len(messages) < INCREMENTAL_CONFIG['min_new_messages']:
+            logger.info(f"Only {len(messages)} new messages, deferring incremental save")
+            return True
+
+        if not save_in_batches(session_id, transcript_path, state, messages, message_ends, end_offset, 'incremental'):
+            logger.error("Incremental save to Cipher failed, will retry on next event")
+            return False
+
+        logger.info(f"Incremental save complete: {len(messages)} messages, offset {end_offset}")
+        return True
+
+def save_compact_remainder(session_id: str, transcript_path: str) -> bool:
+    """インクリメンタル保存済みの位置以降の残りだけをauto-compact時に保存"""
+    with session_lock(session_id, INCREMENTAL_CONFIG['lock_wait_seconds']) as acquired:
+        if not acquired:
+            logger.warning("Incremental save still running, saving remainder from last recorded offset")
+
+        state = load_state(session_id)
+        offset = state.get('offset', 0)
+        messages, message_ends, end_offset = read_transcript_tail(transcript_path, offset)
+        if messages is None:
+            return False
+
+        # 未保存のセッションは従来どおり直近のメッセージだけを対象にする
+        if not offset:
+            limit = MESSAGE_CONFIG['default_limit']
+            messages, message_ends = messages[-limit:], message_ends[-limit:]
+
+        if not extract_conversation_content(messages, len(messages)):
+            logger.info("No unsaved conversation left, already archived incrementally")
+            return True
+
+        return save_in_batches(session_id, transcript_path, state, messages, message_ends, end_offset,
+                               'auto-compact', persist=acquired)
+
 def main():
     """メイン処理"""
     logger.info("Cipher memory save script started")
 
-    # 標準入力からPreCompact Input JSONを読み取り
+    # 標準入力からフックのInput JSONを読み取り
     input_data = read_stdin_json()
     if not input_data:
         logger.error("Failed to read input JSON")
         sys.exit(1)
 
+    # Stop / PostToolUse はインクリメンタル保存として処理
+    if input_data.get('hook_event_name') in INCREMENTAL_EVENTS:
+        set_run_name('save-incremental')
+        sys.exit(0 if run_incremental_save(input_data) else 1)
+    set_run_name('save-precompact')
+
     # triggerがautoの場合のみ処理
     trigger = input_data.get('trigger', '')
     if trigger != 'auto':
@@ -297,6 +427,16 @@ def main():
 
     logger.info(f"Processing auto-compact for session: {session_id}")
 
+    # インクリメンタル保存が有効なら未保存の残りだけを保存
+    if is_incremental_enabled():
+        saved = save_compact_remainder(session_id, transcript_path)
+        prune_session_state(session_id)
+        if saved:
+            logger.info("Successfully saved remaining conversation to Cipher")
+            sys.exit(0)
+        logger.error("Failed to save remaining conversation to Cipher")
+        sys.exit(1)
+
     # トランスクリプトファイルを読み取り
     messages = read_transcript(transcript_path)
     if not messages:
@@ -312,10 +452,14 @@ def main():
     # Cipherに保存（transcript_pathも渡す）
     if save_to_cipher(conversation_content, session_id, transcript_path):
         logger.info("Successfully saved conversation to Cipher")
+        # ローカルアーカイブにスナップショットを保存（有効時のみ）
+        archive_snapshot(conversation_content, session_id, transcript_path)
         sys.exit(0)
     else:
         logger.error("Failed to save conversation to Cipher")
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # CIPHER_HOOK_PROFILE=1 で実行全体をプロファイル
+    with profile_run('save'):
+        main()
\ No newline at end of file
@@ -29,6 +29,50 @@ PROJECT_CONFIG = {
     "default_working_dir": "unknown"
 }
 
+# インクリメンタル保存設定（Stop / PostToolUse フックで使用）
+INCREMENTAL_CONFIG = {
+    "enabled": False,  # 環境変数 CIPHER_INCREMENTAL=1 でも有効化可能
+    "debounce_seconds": 60,  # 最後のイベントからこの秒数静かになったら保存
+    "max_wait_seconds": 600,  # イベントが続いても保存以降で最初のイベントからこの秒数で強制保存
+    "min_new_messages": 10,  # これ未満の差分は次回にまとめて保存
+    "max_batch_messages": 200,  # 1回の保存で送る最大メッセージ数
+    "lock_wait_seconds": 30,  # PreCompact時にバックグラウンド保存の完了を待つ最大秒数
+    "state_retention_seconds": 7 * 24 * 3600,  # この秒数更新のないセッションの状態ファイルを削除
+    "state_dir": "state"
+}
+
+# 会話スナップショットアーカイブ設定
+ARCHIVE_CONFIG = {
+    "enabled": False,  # 環境変数 CIPHER_ARCHIVE=1 でも有効化可能
+    "archive_dir": "archive",
+    "dict_size": 16 * 1024,  # 学習する辞書サイズ（zstd使用時のみ）
+    "train_min_frames": 32,  # 辞書学習を始めるフレーム数
+    "retrain_every": 1024,  # 倍々学習の後は何フレームごとに学習し直すか
+    "train_samples": 256,  # 学習に使う直近スナップショット数
+    "zstd_level": 3,
+    "zlib_level": 6,
+    "fsync": False
+}
+
+# ローカルメモリストア・ロールアップ設定
+ROLLUP_CONFIG = {
+    "mirror_local": False,  # 保存したメモリをローカルストアにも記録（環境変数 CIPHER_LOCAL_STORE=1 でも有効化）
+    "store_dir": "memory_store",
+    "min_group_size": 2,  # この件数以上のアクティブなメモリがあるグループをまとめる
+    "max_history": 20,  # まとめたメモリに残す過去エントリ数
+    "search_limit": 5,  # 検索で返す件数
+    "latency_runs": 20  # 検索レイテンシ測定の繰り返し回数
+}
+
+# プロファイリング設定
+PROFILE_CONFIG = {
+    "enabled": False,  # 環境変数 CIPHER_HOOK_PROFILE=1 でも有効化可能
+    "profile_dir": "profiles",  # logs/ と同じ階層に作成
+    "retention": 20,  # 実行名（save-precompact / save-incremental / restore）ごとに残す実行数
+    "top_allocations": 25,  # 出力する上位アロケーション数
+    "traceback_frames": 5  # tracemallocで記録するスタックの深さ
+}
+
 # ログ設定
 LOG_CONFIG = {
     "level": "INFO",
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+会話スナップショットの圧縮アーカイブ
+保存フックが生成したconversation_contentを追記専用で保存し、mmapで任意のフレームを読み出す
+
+構成（ARCHIVE_CONFIG['archive_dir']以下）:
+- frames.dat: 圧縮済みフレームを連結したデータ
+- frames.idx: フレームごとの固定長インデックス（オフセット・長さ・CRC・コーデック・辞書ID・時刻）
+- dicts/:     過去のスナップショットから学習した圧縮辞書
+- archive.lock: 追記時の排他ロック
+
+圧縮はzstd（zstandardが入っていれば学習辞書付き）、なければzlibを使う
+"""
+
+import os
+import json
+import mmap
+import time
+import random
+import zlib
+import fcntl
+import struct
+import logging
+import argparse
+from typing import Dict, List, Any, Optional, Tuple
+
+from config import ARCHIVE_CONFIG, MESSAGE_CONFIG
+from utils import env_flag, get_current_timestamp
+
+try:
+    import zstandard
+except ImportError:  # 任意依存
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# コーデックID
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_NAMES = {CODEC_RAW: 'raw', CODEC_ZLIB: 'zlib', CODEC_ZSTD: 'zstd'}
+
+# インデックスレコード: offset, comp_len, raw_len, crc32, dict_id, codec, (pad), timestamp
+INDEX_RECORD = struct.Struct('<QIIIHBxd')
+
+# 辞書は学習サンプル合計の1/10まで（小さなアーカイブで辞書自体が嵩まないように）
+DICT_SAMPLE_DIVISOR = 10
+
+DATA_FILE = 'frames.dat'
+INDEX_FILE = 'frames.idx'
+LOCK_FILE = 'archive.lock'
+DICT_DIR = 'dicts'
+
+def is_archive_enabled() -> bool:
+    """アーカイブが有効かどうか（環境変数が設定より優先）"""
+    return env_flag('CIPHER_ARCHIVE', ARCHIVE_CONFIG['enabled'])
+
+def default_archive_dir() -> str:
+    """設定されたアーカイブディレクトリ"""
+    return os.path.join(os.path.dirname(__file__), ARCHIVE_CONFIG['archive_dir'])
+
+def preferred_codec() -> int:
+    """利用可能な中で最も圧縮率の高いコーデック"""
+    return CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+def train_dictionary(codec: int, samples: List[bytes], dict_size: int) -> Optional[bytes]:
+    """コーデックに応じて辞書を学習（学習できなければNone）
+
+    辞書はzstdのみ。zlibのプリセット辞書は互いに重ならないスナップショット間では
+    ほとんど効かない（辞書なしと同程度か悪化する）ため学習しない
+    """
+    if codec != CODEC_ZSTD:
+        return None
+    try:
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+    except zstandard.ZstdError as e:
+        # サンプルが少なすぎる場合などは学習に失敗する
+        logger.warning(f"zstd dictionary training failed: {e}")
+        return None
+
+def should_retrain(frame_count: int) -> bool:
+    """辞書を学習し直すタイミング
+
+    最初は倍々（32, 64, 128, ...）で学習し、以降はretrain_everyフレームごと
+    """
+    if frame_count < ARCHIVE_CONFIG['train_min_frames']:
+        return False
+    if frame_count & (frame_count - 1) == 0 and frame_count < ARCHIVE_CONFIG['retrain_every']:
+        return True
+    return frame_count % ARCHIVE_CONFIG['retrain_every'] == 0
+
+class ConversationArchive:
+    """追記専用の圧縮スナップショットアーカイブ"""
+
+    def __init__(self, archive_dir: Optional[str] = None):
+        self.archive_dir = archive_dir or default_archive_dir()
+        self.data_path = os.path.join(self.archive_dir, DATA_FILE)
+        self.index_path = os.path.join(self.archive_dir, INDEX_FILE)
+        self.lock_path = os.path.join(self.archive_dir, LOCK_FILE)
+        self.dict_dir = os.path.join(self.archive_dir, DICT_DIR)
+        os.makedirs(self.dict_dir, exist_ok=True)
+
+        self._dict_cache: Dict[Tuple[int, int], bytes] = {}
+        self._index_map: Optional[mmap.mmap] = None
+        self._data_map: Optional[mmap.mmap] = None
+
+    # ---- 辞書 ----
+
+    def _dict_path(self, codec: int, dict_id: int) -> str:
+        return os.path.join(self.dict_dir, f"{dict_id:05d}.{CODEC_NAMES[codec]}")
+
+    def _latest_dict_id(self, codec: int) -> int:
+        """コーデックの最新辞書ID（辞書なしは0）"""
+        suffix = f".{CODEC_NAMES[codec]}"
+        ids = [int(name[:-len(suffix)]) for name in os.listdir(self.dict_dir) if name.endswith(suffix)]
+        return max(ids, default=0)
+
+    def _load_dict(self, codec: int, dict_id: int) -> bytes:
+        key = (codec, dict_id)
+        if key not in self._dict_cache:
+            with open(self._dict_path(codec, dict_id), 'rb') as f:
+                self._dict_cache[key] = f.read()
+        return self._dict_cache[key]
+
+    def _store_dict(self, codec: int, dict_data: bytes) -> int:
+        """辞書を新しいIDで保存（ロック保持中に呼ぶこと）"""
+        dict_id = max(self._latest_dict_id(CODEC_ZLIB), self._latest_dict_id(CODEC_ZSTD)) + 1
+        path = self._dict_path(codec, dict_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(dict_data)
+        os.replace(tmp_path, path)
+        self._dict_cache[(codec, dict_id)] = dict_data
+        return dict_id
+
+    # ---- 圧縮 ----
+
+    def _compress(self, codec: int, dict_id: int, raw: bytes) -> bytes:
+        return self._compress_with(codec, self._load_dict(codec, dict_id) if dict_id else None, raw)
+
+    @staticmethod
+    def _compress_with(codec: int, dict_data: Optional[bytes], raw: bytes) -> bytes:
+        if codec == CODEC_ZSTD:
+            zdict = zstandard.ZstdCompressionDict(dict_data) if dict_data else None
+            return zstandard.ZstdCompressor(level=ARCHIVE_CONFIG['zstd_level'], dict_data=zdict).compress(raw)
+        if codec == CODEC_ZLIB:
+            compressor = zlib.compressobj(ARCHIVE_CONFIG['zlib_level'], zdict=dict_data) if dict_data \
+                else zlib.compressobj(ARCHIVE_CONFIG['zlib_level'])
+            return compressor.compress(raw) + compressor.flush()
+        return raw
+
+    def _decompress(self, codec: int, dict_id: int, payload: bytes, raw_len: int) -> bytes:
+        dict_data = self._load_dict(codec, dict_id) if dict_id else None
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("Frame is zstd-compressed but the zstandard module is not installed")
+            zdict = zstandard.ZstdCompressionDict(dict_data) if dict_data else None
+            return zstandard.ZstdDecompressor(dict_data=zdict).decompress(payload, max_output_size=raw_len)
+        if codec == CODEC_ZLIB:
+            decompressor = zlib.decompressobj(zdict=dict_data) if dict_data else zlib.decompressobj()
+            return decompressor.decompress(payload) + decompressor.flush()
+        return payload
+
+    # ---- 書き込み ----
+
+    def append(self, conversation_content: str, session_id: str = 'unknown', transcript_path: str = '') -> int:
+        """スナップショットを1フレームとして追記し、フレーム番号を返す"""
+        header = json.dumps({
+            "session_id": session_id,
+            "transcript_path": transcript_path,
+            "timestamp": get_current_timestamp()
+        }, ensure_ascii=False)
+        raw = f"{header}\n{conversation_content}".encode('utf-8')
+        codec = preferred_codec()
+
+        # 複数のフックプロセスから同時に追記されてもオフセットが重ならないよう排他ロック
+        with open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                dict_id = self._latest_dict_id(codec)
+                payload = self._compress(codec, dict_id, raw)
+
+                # データを先に書き、インデックスは後から書く（読み手が未書き込みのデータを参照しない）
+                with open(self.data_path, 'ab') as data_file:
+                    offset = os.fstat(data_file.fileno()).st_size
+                    data_file.write(payload)
+                    data_file.flush()
+                    if ARCHIVE_CONFIG['fsync']:
+                        os.fsync(data_file.fileno())
+
+                record = INDEX_RECORD.pack(offset, len(payload), len(raw), zlib.crc32(raw),
+                                           dict_id, codec, time.time())
+                with open(self.index_path, 'ab') as index_file:
+                    # 書き込み途中で中断したレコードがあれば切り捨てて境界を揃える
+                    index_size = os.fstat(index_file.fileno()).st_size
+                    torn = index_size % INDEX_RECORD.size
+                    if torn:
+                        logger.warning(f"Truncating {torn} bytes of partial index record")
+                        index_file.truncate(index_size - torn)
+                    frame_no = (index_size - torn) // INDEX_RECORD.size
+                    index_file.write(record)
+                    index_file.flush()
+                    if ARCHIVE_CONFIG['fsync']:
+                        os.fsync(index_file.fileno())
+
+                if should_retrain(frame_no + 1):
+                    self._retrain(codec, frame_no + 1)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        return frame_no
+
+    def _retrain(self, codec: int, frame_count: int) -> None:
+        """直近のスナップショットから辞書を学習し直す（ロック保持中に呼ぶこと）
+
+        直近の1/4は学習に使わずに評価に回し、次の学習までに辞書サイズ以上縮むと見込める場合だけ採用する
+        （辞書は参照するフレームがある限り削除できないため、効かない辞書は保存しない）
+        """
+        start = max(0, frame_count - ARCHIVE_CONFIG['train_samples'])
+        samples = [self.read_raw(i) for i in range(start, frame_count)]
+        split = len(samples) - max(1, len(samples) // 4)
+        dict_size = min(ARCHIVE_CONFIG['dict_size'], sum(map(len, samples[:split])) // DICT_SAMPLE_DIVISOR)
+        dict_data = train_dictionary(codec, samples[:split], dict_size)
+        if not dict_data:
+            return
+
+        current_id = self._latest_dict_id(codec)
+        holdout = samples[split:]
+        current_bytes = sum(len(self._compress(codec, current_id, raw)) for raw in holdout)
+        trained_bytes = sum(len(self._compress_with(codec, dict_data, raw)) for raw in holdout)
+        # 次の学習までに追記されるフレーム数（倍々の間はframe_count、以降はretrain_every）
+        upcoming = min(frame_count, ARCHIVE_CONFIG['retrain_every'])
+        expected_saving = (current_bytes - trained_bytes) * upcoming / len(holdout)
+        if expected_saving <= len(dict_data):
+            logger.info(f"Discarded {CODEC_NAMES[codec]} dictionary: expected saving {expected_saving:.0f} bytes "
+                        f"does not cover its {len(dict_data)} bytes")
+            return
+
+        dict_id = self._store_dict(codec, dict_data)
+        logger.info(f"Trained {CODEC_NAMES[codec]} dictionary {dict_id} from {split} snapshots ({len(dict_data)} bytes)")
+
+    # ---- 読み出し ----
+
+    def _map(self, path: str, current: Optional[mmap.mmap], min_size: int) -> Optional[mmap.mmap]:
+        """ファイルをmmapする。追記で伸びていれば張り直す"""
+        if current is not None and len(current) >= min_size:
+            return current
+        if current is not None:
+            current.close()
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def __len__(self) -> int:
+        try:
+            return os.path.getsize(self.index_path) // INDEX_RECORD.size
+        except FileNotFoundError:
+            return 0
+
+    def record(self, frame_no: int) -> Tuple[int, int, int, int, int, int, float]:
+        """フレームのインデックスレコードをO(1)で取得"""
+        if frame_no < 0:
+            frame_no += len(self)
+        end = (frame_no + 1) * INDEX_RECORD.size
+        self._index_map = self._map(self.index_path, self._index_map, end)
+        if frame_no < 0 or self._index_map is None or end > len(self._index_map):
+            raise IndexError(f"Frame {frame_no} out of range")
+        return INDEX_RECORD.unpack_from(self._index_map, frame_no * INDEX_RECORD.size)
+
+    def read_raw(self, frame_no: int) -> bytes:
+        """フレームを展開してバイト列で返す"""
+        offset, comp_len, raw_len, crc, dict_id, codec, _ = self.record(frame_no)
+        self._data_map = self._map(self.data_path, self._data_map, offset + comp_len)
+        raw = self._decompress(codec, dict_id, self._data_map[offset:offset + comp_len], raw_len)
+        if zlib.crc32(raw) != crc:
+            raise ValueError(f"CRC mismatch in frame {frame_no}")
+        return raw
+
+    def get(self, frame_no: int) -> Dict[str, Any]:
+        """フレームをメタデータ付きで取得"""
+        header, _, content = self.read_raw(frame_no).decode('utf-8').partition('\n')
+        snapshot = json.loads(header)
+        snapshot['conversation_content'] = content
+        return snapshot
+
+    def stats(self) -> Dict[str, Any]:
+        """アーカイブの統計情報"""
+        frames = len(self)
+        raw_bytes = sum(self.record(i)[2] for i in range(frames))
+        dict_bytes = sum(os.path.getsize(os.path.join(self.dict_dir, name)) for name in os.listdir(self.dict_dir))
+        stored_bytes = sum(os.path.getsize(path) for path in (self.data_path, self.index_path) if os.path.exists(path)) + dict_bytes
+        return {
+            "frames": frames,
+            "raw_bytes": raw_bytes,
+            "stored_bytes": stored_bytes,
+            "dict_bytes": dict_bytes,
+            "ratio": round(raw_bytes / stored_bytes, 2) if stored_bytes else 0.0,
+            "codec": CODEC_NAMES[preferred_codec()]
+        }
+
+    def close(self) -> None:
+        for mapped in (self._index_map, self._data_map):
+            if mapped is not None:
+                mapped.close()
+        self._index_map = self._data_map = None
+
+def archive_snapshot(conversation_content: str, session_id: str, transcript_path: str) -> None:
+    """保存フックから呼ぶ。失敗してもCipher保存は続行する"""
+    if not is_archive_enabled():
+        return
+    try:
+        archive = ConversationArchive()
+        frame_no = archive.append(conversation_content, session_id, transcript_path)
+        archive.close()
+        logger.info(f"Archived conversation snapshot as frame {frame_no}")
+    except Exception as e:
+        logger.error(f"Error archiving conversation snapshot: {e}")
+
+# ---- ベンチマーク ----
+
+def _synthetic_snapshots(count: int, batch: int) -> List[str]:
+    """保存されるスナップショットと同じ形（batchメッセージずつの重ならない区間）の列を生成
+
+    テンプレートの繰り返しで圧縮率が過大にならないよう、語句・パス・数値は乱数で変える（シード固定）
+    """
+    rng = random.Random(0)
+    words = ('cache', 'index', 'session', 'transcript', 'offset', 'worker', 'lock', 'retry', 'timeout',
+             'config', 'parser', 'handler', 'snapshot', 'memory', 'query', 'latency', 'profile', 'batch',
+             'encoding', 'fallback', 'dictionary', 'frame', 'archive', 'rollup', 'watermark', 'state')
+    verbs = ('update', 'fix', 'refactor', 'check', 'rename', 'document', 'simplify', 'measure')
+    files = ('config.py', 'utils.py', 'cipher_memory_save.py', 'cipher_memory_restore.py', 'README.md',
+             'install.sh', 'incremental_state.py', 'memory_store.py')
+
+    def phrase(length: int) -> str:
+        return ' '.join(rng.choice(words) for _ in range(length))
+
+    messages = []
+    while len(messages) < count * batch:
+        path = rng.choice(files)
+        messages.append(f"[user]: Please {rng.choice(verbs)} the {phrase(2)} in {path}, "
+                        f"it breaks when {phrase(rng.randint(3, 8))} exceeds {rng.randint(1, 10000)}")
+        messages.append(f"[assistant]: {rng.choice(verbs).capitalize()}d {path}:{rng.randint(1, 900)}. "
+                        f"The {phrase(2)} now {phrase(rng.randint(4, 12))} before {phrase(rng.randint(2, 5))}.")
+        if rng.random() < 0.5:
+            messages.append(f"[assistant-tool]: {rng.choice(('Edit', 'Read', 'Bash', 'Grep'))}")
+    return ["\n".join(messages[i * batch:(i + 1) * batch]) for i in range(count)]
+
+def _transcript_snapshots(transcript_paths: List[str], batch: int) -> List[str]:
+    """実際のトランスクリプトから、保存フックと同じ抽出でbatchメッセージずつのスナップショット列を作る"""
+    from transcript import read_transcript, extract_conversation_content
+    snapshots = []
+    for path in transcript_paths:
+        messages = read_transcript(path) or []
+        for start in range(0, len(messages), batch):
+            chunk = messages[start:start + batch]
+            content = extract_conversation_content(chunk, len(chunk))
+            if content:
+                snapshots.append(content)
+    return snapshots
+
+def run_benchmark(archive_dir: str, snapshots: List[str]) -> Dict[str, Any]:
+    """書き込み・ランダム読み出しのスループットと圧縮率を測定"""
+    archive = ConversationArchive(archive_dir)
+    raw_total = sum(len(s.encode('utf-8')) for s in snapshots)
+
+    start = time.perf_counter()
+    for i, snapshot in enumerate(snapshots):
+        archive.append(snapshot, f"bench-{i // 50}", '')
+    write_seconds = time.perf_counter() - start
+
+    frames = len(archive)
+    order = [(i * 7919) % frames for i in range(frames)]  # 決定的な疑似ランダム順
+    start = time.perf_counter()
+    for frame_no in order:
+        archive.read_raw(frame_no)
+    read_seconds = time.perf_counter() - start
+
+    # 比較用: 同じフレームを辞書なしで1つずつ圧縮した場合
+    raw_frames = [archive.read_raw(i) for i in range(frames)]
+    stats = archive.stats()
+    archive.close()
+    plain_zlib = sum(len(zlib.compress(raw, ARCHIVE_CONFIG['zlib_level'])) for raw in raw_frames)
+    baselines = {"plain_zlib_ratio": round(stats['raw_bytes'] / plain_zlib, 2)}
+    if zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=ARCHIVE_CONFIG['zstd_level'])
+        plain_zstd = sum(len(compressor.compress(raw)) for raw in raw_frames)
+        baselines["plain_zstd_ratio"] = round(stats['raw_bytes'] / plain_zstd, 2)
+    mb = stats['raw_bytes'] / (1024 * 1024)
+    return {
+        **stats,
+        "content_bytes": raw_total,
+        **baselines,
+        "write_mb_per_s": round(mb / write_seconds, 2),
+        "write_frames_per_s": round(frames / write_seconds, 1),
+        "read_mb_per_s": round(mb / read_seconds, 2),
+        "read_frames_per_s": round(frames / read_seconds, 1)
+    }
+
+def main():
+    """コマンドライン: stats / get / bench"""
+    parser = argparse.ArgumentParser(description="Conversation snapshot archive")
+    parser.add_argument('--dir', default=None, help="archive directory (stats / get)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help="show archive statistics")
+    get_parser = subparsers.add_parser('get', help="print a snapshot")
+    get_parser.add_argument('frame', type=int)
+    bench_parser = subparsers.add_parser('bench', help="measure compression ratio and throughput")
+    bench_parser.add_argument('--frames', type=int, default=2000)
+    bench_parser.add_argument('--batch', type=int, default=MESSAGE_CONFIG['default_limit'],
+                              help="messages per snapshot")
+    bench_parser.add_argument('--transcript', nargs='+', help="build snapshots from real transcripts")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.command == 'bench':
+        import tempfile
+        if args.transcript:
+            snapshots = _transcript_snapshots(args.transcript, args.batch)
+        else:
+            snapshots = _synthetic_snapshots(args.frames, args.batch)
+        # ベンチマークは実アーカイブを汚さないよう一時ディレクトリで行う
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = run_benchmark(tmp_dir, snapshots)
+        print(json.dumps(result, indent=2))
+        return
+
+    archive = ConversationArchive(args.dir)
+    if args.command == 'stats':
+        print(json.dumps(archive.stats(), indent=2))
+    elif args.command == 'get':
+        print(json.dumps(archive.get(args.frame), ensure_ascii=False, indent=2))
+    archive.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/bin/bash
+
+# セッション途中にCipherへ差分を保存するフック
+# Stop / PostToolUse Inputイベントで呼び出され、保存はバックグラウンドで行う
+
+set -euo pipefail
+
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+LOG_FILE="$SCRIPT_DIR/logs/cipher_hook.log"
+PYTHON_SCRIPT="$SCRIPT_DIR/cipher_memory_save.py"
+
+# ログディレクトリが存在しない場合は作成
+mkdir -p "$SCRIPT_DIR/logs"
+
+# ログ関数
+log() {
+    echo "[$(date '+%Y-%m-%d %H:%M:%S')] INCREMENTAL: $1" >> "$LOG_FILE"
+}
+
+# メイン処理
+main() {
+    # stdinからJSONを読み取り
+    input_json=$(cat)
+
+    # フック自身が起動したClaude CLIセッションのイベントは無視
+    if [[ "${CIPHER_HOOK_CHILD:-}" == "1" ]]; then
+        exit 0
+    fi
+
+    # JSONが空でないことを確認
+    if [[ -z "$input_json" ]]; then
+        log "ERROR: No input received from stdin"
+        exit 0
+    fi
+
+    # Pythonスクリプトが存在することを確認
+    if [[ ! -f "$PYTHON_SCRIPT" ]]; then
+        log "ERROR: Python script not found at $PYTHON_SCRIPT"
+        exit 0
+    fi
+
+    # デバウンス待ちと保存はバックグラウンドで行い、フックはすぐに返す
+    # セッションのワーカーが既にいればPythonはイベントを記録してすぐに終了する
+    echo "$input_json" | nohup python3 "$PYTHON_SCRIPT" >/dev/null 2>&1 &
+
+    # インクリメンタル保存の失敗でセッションを妨げない
+    exit 0
+}
+
+# エラーハンドリング
+trap 'log "ERROR: Unexpected error occurred at line $LINENO"' ERR
+
+# スクリプト実行
+main "$@"
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+インクリメンタル保存の状態管理
+セッションごとの保存済みオフセット、イベント時刻、排他ロックを扱う
+"""
+
+import os
+import re
+import json
+import time
+import fcntl
+import logging
+from contextlib import contextmanager
+from collections import defaultdict
+from typing import Dict, List, Any, Iterator
+
+from config import INCREMENTAL_CONFIG
+from utils import env_flag, get_current_timestamp
+
+logger = logging.getLogger(__name__)
+
+# ロック取得のポーリング間隔（秒）
+LOCK_POLL_INTERVAL = 0.2
+
+# セッションごとの状態ファイル（書き込み途中の一時ファイルを含む）
+STATE_FILE_PATTERN = re.compile(r'^(.+?)\.(json|event|pending|lock|worker)(\.\d+\.tmp)?$')
+
+def is_incremental_enabled() -> bool:
+    """インクリメンタル保存が有効かどうか（環境変数が設定より優先）"""
+    return env_flag('CIPHER_INCREMENTAL', INCREMENTAL_CONFIG['enabled'])
+
+def get_state_dir() -> str:
+    """状態ファイルのディレクトリを取得（なければ作成）"""
+    state_dir = os.path.join(os.path.dirname(__file__), INCREMENTAL_CONFIG['state_dir'])
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+def _safe_id(session_id: str) -> str:
+    """セッションIDをファイル名として安全な形にする"""
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', session_id or 'unknown')
+
+def _state_path(session_id: str, suffix: str) -> str:
+    """セッションIDからファイル名として安全なパスを作る"""
+    return os.path.join(get_state_dir(), f"{_safe_id(session_id)}{suffix}")
+
+def load_state(session_id: str) -> Dict[str, Any]:
+    """保存済みオフセットなどの状態を読み込む"""
+    path = _state_path(session_id, '.json')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"Ignoring unreadable incremental state {path}: {e}")
+        return {}
+
+def save_state(session_id: str, state: Dict[str, Any]) -> None:
+    """状態をアトミックに書き込む（セッションロック保持中に呼ぶこと）"""
+    path = _state_path(session_id, '.json')
+    state = dict(state, updated_at=get_current_timestamp())
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def record_event(session_id: str) -> int:
+    """フックイベントの発生を記録し、その時刻（ns）を返す
+
+    前回の保存以降で最初のイベントなら未保存マーカーも作成し、max_waitの起点にする
+    """
+    pending_marker = _state_path(session_id, '.pending')
+    try:
+        os.close(os.open(pending_marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        pass
+
+    event_marker = _state_path(session_id, '.event')
+    with open(event_marker, 'a'):
+        os.utime(event_marker)
+    return os.stat(event_marker).st_mtime_ns
+
+def last_event_ns(session_id: str) -> int:
+    """最後に記録されたイベント時刻（ns）"""
+    try:
+        return os.stat(_state_path(session_id, '.event')).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def seconds_pending(session_id: str) -> float:
+    """前回の保存以降で最初のイベントからの経過秒数（未保存のイベントがなければ0）"""
+    try:
+        return time.time() - os.stat(_state_path(session_id, '.pending')).st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+def mark_flushed(session_id: str) -> None:
+    """保存完了を記録し、max_waitの起点をリセットする"""
+    try:
+        os.remove(_state_path(session_id, '.pending'))
+    except FileNotFoundError:
+        pass
+
+def seconds_since_event(session_id: str) -> float:
+    """最後のイベントからの経過秒数"""
+    return (time.time_ns() - last_event_ns(session_id)) / 1e9
+
+def prune_stale_state(current_session_id: str) -> int:
+    """state_retention_seconds以上更新のないセッションの状態ファイルを削除し、削除したセッション数を返す
+
+    実行中のセッションは除外し、ワーカー・保存のどちらのロックも取れたセッションだけを削除する
+    """
+    state_dir = get_state_dir()
+    cutoff = time.time() - INCREMENTAL_CONFIG['state_retention_seconds']
+    current = _safe_id(current_session_id)
+
+    sessions: Dict[str, List[str]] = defaultdict(list)
+    newest: Dict[str, float] = defaultdict(float)
+    for name in os.listdir(state_dir):
+        match = STATE_FILE_PATTERN.match(name)
+        if not match or match.group(1) == current:
+            continue
+        path = os.path.join(state_dir, name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+        sessions[match.group(1)].append(path)
+        newest[match.group(1)] = max(newest[match.group(1)], mtime)
+
+    pruned = 0
+    for safe_id, paths in sessions.items():
+        if newest[safe_id] >= cutoff:
+            continue
+        with worker_lock(safe_id) as worker_acquired, session_lock(safe_id) as session_acquired:
+            if not (worker_acquired and session_acquired):
+                continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        pruned += 1
+
+    if pruned:
+        logger.info(f"Pruned incremental state for {pruned} stale sessions")
+    return pruned
+
+@contextmanager
+def session_lock(session_id: str, timeout: float = 0) -> Iterator[bool]:
+    """保存処理用のセッション単位の排他ロック。取得できたかどうかをyieldする"""
+    with _file_lock(_state_path(session_id, '.lock'), timeout) as acquired:
+        yield acquired
+
+@contextmanager
+def worker_lock(session_id: str) -> Iterator[bool]:
+    """デバウンス待ちをするワーカーをセッションごとに1つに限るロック"""
+    with _file_lock(_state_path(session_id, '.worker'), 0) as acquired:
+        yield acquired
+
+@contextmanager
+def _file_lock(path: str, timeout: float) -> Iterator[bool]:
+    """flockによる排他ロック。timeout秒まで待ち、取得できたかどうかをyieldする"""
+    lock_file = open(path, 'w')
+    acquired = False
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(LOCK_POLL_INTERVAL)
+        yield acquired
+    finally:
+        if acquired:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+ローカルメモリストア
+Cipherのメモリ保存・タグ検索を手元で再現するストア（ロールアップのテストやオフライン利用向け）
+"""
+
+import os
+import json
+import fcntl
+import logging
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional, Iterator, Tuple
+
+from config import ROLLUP_CONFIG
+from utils import env_flag, get_current_timestamp
+
+logger = logging.getLogger(__name__)
+
+STORE_FILE = 'memories.json'
+RETIRED_FILE = 'retired.jsonl'
+LOCK_FILE = 'memories.lock'
+
+def is_local_mirror_enabled() -> bool:
+    """保存したメモリをローカルストアにも記録するか（環境変数が設定より優先）"""
+    return env_flag('CIPHER_LOCAL_STORE', ROLLUP_CONFIG['mirror_local'])
+
+def default_store_dir() -> str:
+    """設定されたストアディレクトリ"""
+    return os.path.join(os.path.dirname(__file__), ROLLUP_CONFIG['store_dir'])
+
+def tag_value(tags: List[str], key: str) -> Optional[str]:
+    """`key:value` 形式のタグから値を取り出す"""
+    prefix = f"{key}:"
+    for tag in tags:
+        if tag.startswith(prefix):
+            return tag[len(prefix):]
+    return None
+
+class LocalMemoryStore:
+    """JSONファイルに保存するメモリストア
+
+    各メモリは id, content, tags, metadata, created_at を持つ
+    引退したメモリは検索対象のファイルから retired.jsonl に移す
+    """
+
+    def __init__(self, store_dir: Optional[str] = None):
+        self.store_dir = store_dir or default_store_dir()
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.store_path = os.path.join(self.store_dir, STORE_FILE)
+        self.lock_path = os.path.join(self.store_dir, LOCK_FILE)
+        self.retired_path = os.path.join(self.store_dir, RETIRED_FILE)
+
+    @contextmanager
+    def _locked(self) -> Iterator[Dict[str, Any]]:
+        """排他ロック下でストアを読み込み、ブロック終了時に書き戻す"""
+        with open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                data = self._read()
+                yield data
+                tmp_path = f"{self.store_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.store_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.store_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"next_id": 1, "memories": []}
+
+    def add(self, content: str, tags: List[str], metadata: Optional[Dict[str, Any]] = None) -> int:
+        """メモリを追加してIDを返す"""
+        with self._locked() as data:
+            return self._add_locked(data, content, tags, metadata)
+
+    def _add_locked(self, data: Dict[str, Any], content: str, tags: List[str],
+                    metadata: Optional[Dict[str, Any]]) -> int:
+        memory_id = data['next_id']
+        data['next_id'] += 1
+        data['memories'].append({
+            "id": memory_id,
+            "content": content,
+            "tags": tags,
+            "metadata": metadata or {},
+            "created_at": get_current_timestamp()
+        })
+        return memory_id
+
+    def retire(self, memory_ids: List[int], superseded_by: int) -> int:
+        """メモリを引退させ（検索対象から外し）、引退させた件数を返す"""
+        with self._locked() as data:
+            return self._retire_locked(data, memory_ids, superseded_by)
+
+    def replace(self, memory_ids: List[int], content: str, tags: List[str],
+                metadata: Optional[Dict[str, Any]] = None) -> Optional[Tuple[int, int]]:
+        """新しいメモリの追加と元のメモリの引退を1つのトランザクションで行い、(新ID, 引退件数)を返す
+
+        元のメモリのどれかが既にアクティブでなければ（別の処理が引退させた）何もせずNoneを返す
+        """
+        with self._locked() as data:
+            active_ids = {memory['id'] for memory in data['memories']}
+            if not active_ids.issuperset(memory_ids):
+                return None
+            memory_id = self._add_locked(data, content, tags, metadata)
+            return memory_id, self._retire_locked(data, memory_ids, memory_id)
+
+    def _retire_locked(self, data: Dict[str, Any], memory_ids: List[int], superseded_by: int) -> int:
+        targets = set(memory_ids)
+        retired = [memory for memory in data['memories'] if memory['id'] in targets]
+        data['memories'] = [memory for memory in data['memories'] if memory['id'] not in targets]
+        with open(self.retired_path, 'a', encoding='utf-8') as f:
+            for memory in retired:
+                memory['superseded_by'] = superseded_by
+                f.write(json.dumps(memory, ensure_ascii=False) + "\n")
+        return len(retired)
+
+    def list(self, since_id: int = 0) -> List[Dict[str, Any]]:
+        """since_idより新しいアクティブなメモリを古い順に返す"""
+        return [memory for memory in self._read()['memories'] if memory['id'] > since_id]
+
+    def search(self, query: str, limit: int = ROLLUP_CONFIG['search_limit']) -> List[Dict[str, Any]]:
+        """タグ・本文に対する語句一致で検索し、スコア順（同点は新しい順）に返す
+
+        Cipherと同じく呼び出しごとにストア全体を対象にするため、件数に比例して遅くなる
+        """
+        terms = [term.lower() for term in query.split() if term]
+        scored = []
+        for memory in self.list():
+            tags = {tag.lower() for tag in memory['tags']}
+            content = memory['content'].lower()
+            score = 0
+            for term in terms:
+                if term in tags:
+                    score += 2
+                elif term in content:
+                    score += 1
+            if score:
+                scored.append((score, memory['id'], memory))
+        scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+        return [memory for _, _, memory in scored[:limit]]
+
+def mirror_memory(memory_content: str, tags: List[str], metadata: Dict[str, Any]) -> None:
+    """保存フックから呼ぶ。Cipherに保存したメモリをローカルストアにも記録する"""
+    if not is_local_mirror_enabled():
+        return
+    try:
+        memory_id = LocalMemoryStore().add(memory_content, tags, metadata)
+        logger.info(f"Mirrored memory to local store as #{memory_id}")
+    except Exception as e:
+        logger.error(f"Error mirroring memory to local store: {e}")
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+フックスクリプトのプロファイリング
+有効時はcProfileとtracemallocで実行全体を計測し、実行ごとの .pstats とアロケーション上位を保存する
+Claude CLIの子プロセスは run_measured() で起動し、呼び出しごとの最大RSSを記録する
+"""
+
+import os
+import sys
+import time
+import cProfile
+import logging
+import resource
+import threading
+import subprocess
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Iterator, Optional
+
+from config import PROFILE_CONFIG
+from utils import env_flag
+
+logger = logging.getLogger(__name__)
+
+class _ProfileRun:
+    """実行中のプロファイル（実行名・一時停止した時間・破棄するかどうか）"""
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.start = time.perf_counter()
+        self.name: Optional[str] = None
+        self.paused_seconds = 0.0
+        self.discarded = False
+        self.child_peaks_mb: List[float] = []
+
+# 実行中のプロファイル
+_active: Optional[_ProfileRun] = None
+
+def is_profiling_enabled() -> bool:
+    """プロファイリングが有効かどうか（環境変数が設定より優先）"""
+    return env_flag('CIPHER_HOOK_PROFILE', PROFILE_CONFIG['enabled'])
+
+def get_profile_dir() -> str:
+    """プロファイル出力ディレクトリ（なければ作成）"""
+    profile_dir = os.path.join(os.path.dirname(__file__), PROFILE_CONFIG['profile_dir'])
+    os.makedirs(profile_dir, exist_ok=True)
+    return profile_dir
+
+def max_rss_mb(max_rss: int) -> float:
+    """ru_maxrssをMBに変換（LinuxはKB、macOSはバイト単位）"""
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(max_rss / divisor, 1)
+
+def peak_rss_mb() -> float:
+    """フック本体の最大RSS（MB）"""
+    return max_rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def run_measured(command: List[str], input_text: str, timeout: float,
+                 env: Optional[Dict[str, str]] = None) -> subprocess.CompletedProcess:
+    """subprocess.run(capture_output=True, text=True)と同じくコマンドを実行する
+
+    プロファイリング中は子プロセスをos.wait4で回収し、その子プロセス自身の最大RSSを記録する
+    （RUSAGE_CHILDRENは終了済みの全子孫の最大値なので、呼び出しごとの値は取れない）。
+    exec前の時点のフック本体のRSSも最大値に含まれるため、十数MBが下限になる
+    """
+    if _active is None:
+        return subprocess.run(command, input=input_text, capture_output=True, text=True, timeout=timeout, env=env)
+
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, text=True, env=env)
+    outputs: Dict[str, str] = {}
+
+    def write_input() -> None:
+        try:
+            proc.stdin.write(input_text)
+            proc.stdin.close()
+        except BrokenPipeError:
+            # 入力を読み切らずに終了した
+            pass
+
+    def read_output(name: str, stream) -> None:
+        outputs[name] = stream.read()
+
+    threads = [threading.Thread(target=write_input, daemon=True),
+               threading.Thread(target=read_output, args=('stdout', proc.stdout), daemon=True),
+               threading.Thread(target=read_output, args=('stderr', proc.stderr), daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    # Popen.wait()は使用量を返さないため、wait4で自分で回収する
+    deadline = time.monotonic() + timeout
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.monotonic() >= deadline:
+            proc.kill()
+            os.wait4(proc.pid, 0)
+            proc.returncode = -9
+            raise subprocess.TimeoutExpired(command, timeout)
+        time.sleep(0.05)
+
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    for thread in threads:
+        thread.join()
+    _active.child_peaks_mb.append(max_rss_mb(usage.ru_maxrss))
+    return subprocess.CompletedProcess(command, proc.returncode, outputs.get('stdout', ''), outputs.get('stderr', ''))
+
+def prune_profiles(profile_dir: str, script_name: str, retention: int) -> None:
+    """古いプロファイルを削除して実行名ごとにretention回分だけ残す"""
+    prefix = f"{script_name}-"
+    runs = sorted({name.split('.')[0] for name in os.listdir(profile_dir) if name.startswith(prefix)})
+    for run in runs[:-retention] if retention > 0 else runs:
+        for name in os.listdir(profile_dir):
+            if name.split('.')[0] == run:
+                try:
+                    os.remove(os.path.join(profile_dir, name))
+                except FileNotFoundError:
+                    # 同時に終了した別のフックが先に削除した
+                    pass
+
+def write_allocation_report(path: str, snapshot: tracemalloc.Snapshot, summary: str) -> None:
+    """アロケーション上位をテキストで保存"""
+    stats = snapshot.statistics('traceback')[:PROFILE_CONFIG['top_allocations']]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(summary + "\n\n")
+        for index, stat in enumerate(stats, 1):
+            f.write(f"#{index}: {stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+            for line in stat.traceback.format():
+                f.write(f"    {line}\n")
+
+def start_profiling() -> None:
+    """有効時はこの時点から計測を始める
+
+    スクリプト冒頭で他のモジュールより先に呼ぶと、以降のimportのコストも計測できる
+    """
+    global _active
+    if _active is not None or not is_profiling_enabled():
+        return
+    tracemalloc.start(PROFILE_CONFIG['traceback_frames'])
+    _active = _ProfileRun()
+    _active.profiler.enable()
+
+def set_run_name(name: str) -> None:
+    """実行名を変える（イベントごとに出力ファイル名と保持数を分ける）"""
+    if _active is not None:
+        _active.name = name
+
+def discard_profile() -> None:
+    """この実行のプロファイルを保存しない（何もせずに終了するプロセスなど）"""
+    if _active is not None:
+        _active.discarded = True
+
+@contextmanager
+def paused() -> Iterator[None]:
+    """ブロック内（デバウンスの待ち時間など）を計測から外す"""
+    if _active is None:
+        yield
+        return
+    _active.profiler.disable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _active.paused_seconds += time.perf_counter() - start
+        _active.profiler.enable()
+
+@contextmanager
+def profile_run(script_name: str) -> Iterator[None]:
+    """実行全体をプロファイルする（無効時は何もしない）
+
+    start_profiling()が先に呼ばれていればその時点から計測する。
+    実行名はset_run_name()で変更でき、保持数は実行名ごとに数える。
+    sys.exitで抜けた場合も結果を保存する。保存の失敗はフックの結果に影響させない
+    """
+    global _active
+    if not is_profiling_enabled():
+        yield
+        return
+
+    start_profiling()
+    run = _active
+    run.name = run.name or script_name
+    try:
+        yield
+    finally:
+        run.profiler.disable()
+        _active = None
+        elapsed = time.perf_counter() - run.start - run.paused_seconds
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            _, traced_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if not run.discarded:
+                write_profile(run, elapsed, snapshot, traced_peak)
+        except Exception as e:
+            logger.error(f"Error writing profile: {e}")
+
+def write_profile(run: _ProfileRun, elapsed: float, snapshot: tracemalloc.Snapshot, traced_peak: int) -> None:
+    """.pstats と .alloc.txt を保存し、古いプロファイルを削除"""
+    profile_dir = get_profile_dir()
+    run_name = f"{run.name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+    paused_note = f" (excluding {run.paused_seconds:.2f}s paused)" if run.paused_seconds else ""
+    if run.child_peaks_mb:
+        child_note = (f"CLI peak RSS {max(run.child_peaks_mb)} MB "
+                      f"(per call: {', '.join(map(str, run.child_peaks_mb))} MB)")
+    else:
+        child_note = "CLI peak RSS n/a (no CLI call)"
+    summary = (f"Profile {run_name}: wall {elapsed:.2f}s{paused_note}, "
+               f"traced peak {traced_peak / (1024 * 1024):.1f} MB, "
+               f"hook peak RSS {peak_rss_mb()} MB, {child_note}")
+
+    run.profiler.dump_stats(os.path.join(profile_dir, f"{run_name}.pstats"))
+    write_allocation_report(os.path.join(profile_dir, f"{run_name}.alloc.txt"), snapshot, summary)
+    prune_profiles(profile_dir, run.name, PROFILE_CONFIG['retention'])
+    logger.info(f"📊 {summary}")
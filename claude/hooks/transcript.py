@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+トランスクリプトの読み取りと会話内容の抽出
+保存フックとアーカイブのベンチマークで共用する（import時の副作用なし）
+"""
+
+import os
+import json
+import logging
+from typing import Dict, List, Any, Optional, Tuple
+
+from config import MESSAGE_CONFIG
+
+logger = logging.getLogger(__name__)
+
+def read_transcript(transcript_path: str) -> Optional[List[Dict[str, Any]]]:
+    """トランスクリプトファイルを読み取る"""
+    try:
+        if not os.path.exists(transcript_path):
+            logger.error(f"Transcript file not found: {transcript_path}")
+            return None
+
+        messages = []
+        with open(transcript_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        messages.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+
+        logger.info(f"Read {len(messages)} messages from transcript")
+        return messages
+    except Exception as e:
+        logger.error(f"Error reading transcript: {e}")
+        return None
+
+def read_transcript_tail(transcript_path: str, offset: int) -> Tuple[Optional[List[Dict[str, Any]]], List[int], int]:
+    """トランスクリプトのoffset以降を読み取り、(メッセージ, 各メッセージの終端位置, 読み終えた位置)を返す
+
+    インクリメンタル保存用。書き込み途中の最終行は読まずに残し、次回に回す
+    （オフセットをバイト単位で進めるためバイナリで読む）
+    """
+    try:
+        if not os.path.exists(transcript_path):
+            logger.error(f"Transcript file not found: {transcript_path}")
+            return None, [], offset
+
+        # ファイルが切り詰められていたら先頭から読み直す
+        if offset > os.path.getsize(transcript_path):
+            logger.warning(f"Transcript shorter than saved offset {offset}, rereading from start")
+            offset = 0
+
+        messages = []
+        message_ends = []
+        end_offset = offset
+        with open(transcript_path, 'rb') as f:
+            f.seek(offset)
+            for raw_line in f:
+                if not raw_line.endswith(b'\n'):
+                    break
+                end_offset += len(raw_line)
+                line = raw_line.decode('utf-8', errors='replace').strip()
+                if line:
+                    try:
+                        messages.append(json.loads(line))
+                        message_ends.append(end_offset)
+                    except json.JSONDecodeError:
+                        continue
+
+        logger.info(f"Read {len(messages)} messages from transcript (offset {offset} -> {end_offset})")
+        return messages, message_ends, end_offset
+    except Exception as e:
+        logger.error(f"Error reading transcript: {e}")
+        return None, [], offset
+
+def extract_conversation_content(messages: List[Dict[str, Any]], limit: int = MESSAGE_CONFIG['default_limit']) -> str:
+    """会話内容から重要な部分を抽出"""
+    try:
+        # 最新のメッセージから指定数を取得
+        recent_messages = messages[-limit:] if len(messages) > limit else messages
+
+        conversation_parts = []
+        for msg in recent_messages:
+            msg_type = msg.get('type', '')
+            message_data = msg.get('message', {})
+
+            # userまたはassistantメッセージの処理
+            if msg_type in ['user', 'assistant'] and message_data:
+                role = message_data.get('role', msg_type)
+                content = message_data.get('content', '')
+
+                # contentが文字列の場合
+                if isinstance(content, str) and content.strip():
+                    conversation_parts.append(f"[{role}]: {content}")
+                # contentが配列の場合（tool_useなど）
+                elif isinstance(content, list):
+                    for item in content:
+                        if isinstance(item, dict):
+                            if item.get('type') == 'text':
+                                text = item.get('text', '')
+                                if text.strip():
+                                    conversation_parts.append(f"[{role}]: {text}")
+                            elif item.get('type') == 'tool_use':
+                                tool_name = item.get('name', 'unknown_tool')
+                                conversation_parts.append(f"[{role}-tool]: {tool_name}")
+
+        logger.info(f"Extracted {len(conversation_parts)} conversation parts from {len(recent_messages)} messages")
+
+        # デバッグ：コンテンツが抽出されなかった場合
+        if not conversation_parts and recent_messages:
+            logger.warning(f"No conversation parts extracted from {len(recent_messages)} messages")
+            sample_msg = recent_messages[0]
+            logger.debug(f"Sample message structure: {list(sample_msg.keys())}")
+
+        return "\n".join(conversation_parts)
+    except Exception as e:
+        logger.error(f"Error extracting conversation content: {e}")
+        return ""
@@ -14,6 +14,9 @@ DEFAULT_MESSAGE_LIMIT = 20  # 会話内容抽出時のデフォルトメッセ
 CIPHER_TIMEOUT_SECONDS = 180  # Cipher通信タイムアウト（3分）
 MAX_LOG_PREVIEW_LENGTH = 300  # ログプレビューの最大文字数
 
+# フックが起動したClaude CLI子セッションの目印（子セッションのフックで再帰的に保存しない）
+HOOK_CHILD_ENV = 'CIPHER_HOOK_CHILD'
+
 # Claude CLI設定
 CLAUDE_CLI_COMMAND = [
     "claude",
@@ -67,12 +70,51 @@ def extract_project_context(transcript_path: str) -> Dict[str, Any]:
         logger.error(f"Error extracting project context: {e}")
         return {"name": "unknown", "path": "unknown", "transcript_path": transcript_path}
 
+def build_search_queries(session_id: str, project_name: str, include_incremental: bool = False) -> List[str]:
+    """メモリ検索クエリを優先度順に構築
+
+    include_incrementalはインクリメンタル保存の有効時に指定する。
+    auto-compactのメモリは未保存の残りだけなので、同じセッションの差分（incremental）もまとめて検索する
+    """
+    search_queries = []
+
+    # 1. 直前のセッションのauto-compactメモリ（とインクリメンタル保存の差分）
+    if session_id and session_id != 'unknown':
+        session_types = "auto-compact incremental" if include_incremental else "auto-compact"
+        search_queries.append(f"session-id:{session_id[:8]} {session_types}")
+
+    # 2. 同一プロジェクトの進行中タスク
+    if project_name != 'unknown':
+        search_queries.append(f"project:{project_name} status:in-progress")
+        search_queries.append(f"project:{project_name} priority:high")
+
+    # 3. 最近の高優先度タスク
+    search_queries.append("auto-compact priority:high")
+    search_queries.append("status:in-progress recent")
+
+    return search_queries
+
 def truncate_for_log(text: str, max_length: int = MAX_LOG_PREVIEW_LENGTH) -> str:
     """ログ用にテキストを安全に切り詰める"""
     if len(text) <= max_length:
         return text
     return text[:max_length] + "..."
 
+def env_flag(name: str, default: bool = False) -> bool:
+    """環境変数を真偽値として読み取る（未設定時はdefault）"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def is_hook_child() -> bool:
+    """フック自身が起動したClaude CLIセッション内で実行されているか"""
+    return env_flag(HOOK_CHILD_ENV)
+
+def hook_child_env() -> Dict[str, str]:
+    """Claude CLI子プロセス用の環境変数（子セッションの目印付き）"""
+    return dict(os.environ, **{HOOK_CHILD_ENV: '1'})
+
 def get_current_timestamp() -> str:
     """現在のタイムスタンプを取得"""
     return datetime.now().isoformat()
\ No newline at end of file